@@ -35,6 +35,21 @@ fi
 if [ ! -z "$(mount | grep "$REPODIR/test/mnt")" ]; then
     fusermount -u "$REPODIR/test/mnt"
 fi
+# compressed entries are generated rather than committed, big.txt spans
+# several read windows, small.txt is read whole on open
+GENDIR="$(mktemp -d)"
+seq 1 20000 > "$GENDIR/small.txt"
+seq 1 300000 > "$GENDIR/big.txt"
+GENZIP='import struct, sys, zipfile, zlib
+with zipfile.ZipFile(sys.argv[2], "w", zipfile.ZIP_DEFLATED) as z:
+    z.write(sys.argv[1] + "/small.txt", "small.txt")
+    z.write(sys.argv[1] + "/big.txt", "big.txt")
+    # name in info-zip unicode path extra field overrides the one in the record
+    name = "unicode/ünïcode.txt".encode()
+    info = zipfile.ZipInfo("unicode/fallback.txt")
+    info.extra = struct.pack("<HHBL", 0x7075, 5 + len(name), 1, zlib.crc32(b"unicode/fallback.txt")) + name
+    z.writestr(info, "unicode\n")'
+python3 -c "$GENZIP" "$GENDIR" "$REPODIR/test/data/generated.zip"
 "$REPODIR/ziprofs.py" "$REPODIR/test/data" "$REPODIR/test/mnt" -o foreground,debug > "$REPODIR/test/test.log" 2>&1 &
 PID=$!
 sleep 1
@@ -42,7 +57,7 @@ cd "$REPODIR/test/mnt"
 
 runtest "zip is directory" "./test.zip" 'find ./ -type d -name test.zip'
 
-TREERESULT=$(tree -a --noreport ../data | tail -n +2 | grep -v test.zip)
+TREERESULT=$(tree -a --noreport ../data | tail -n +2 | grep -v '\.zip$')
 runtest "tree" "$TREERESULT" 'tree -a --noreport ./test.zip | tail -n +2'
 
 runtest "reading file content #1" "$(cat ../data/text.txt)" 'cat test.zip/text.txt'
@@ -51,10 +66,23 @@ runtest "checking non-existant file" "does not exist" "[ -e test.zip/nosuchfile
 
 runtest "running script" "hello" 'test.zip/script.sh'
 
+# compressed entries, read at offsets before full reads so kernel has nothing cached yet,
+# backward seeks land once inside the current 1MiB window and once before it
+BACKREAD='import sys; f = open(sys.argv[1], "rb", 0); f.seek(1500000); a = f.read(40000); f.seek(1480000); b = f.read(40000); f.seek(100000); sys.stdout.buffer.write(a + b + f.read(40000))'
+runtest "reading compressed file backwards" "$(python3 -c "$BACKREAD" "$GENDIR/big.txt" | md5sum)" "python3 -c '$BACKREAD' generated.zip/big.txt | md5sum"
+runtest "reading compressed file at offset #1" "$(dd if="$GENDIR/big.txt" bs=1000 skip=1200 count=70 status=none | md5sum)" 'dd if=generated.zip/big.txt bs=1000 skip=1200 count=70 status=none | md5sum'
+runtest "reading compressed file at offset #2" "$(tail -c 10000 "$GENDIR/small.txt" | md5sum)" 'tail -c 10000 generated.zip/small.txt | md5sum'
+runtest "reading compressed file content #1" "$(md5sum < "$GENDIR/small.txt")" 'md5sum < generated.zip/small.txt'
+runtest "reading compressed file content #2" "$(md5sum < "$GENDIR/big.txt")" 'md5sum < generated.zip/big.txt'
+
+# whichever name the python in use picks, listed entry must be readable
+runtest "reading file listed by unicode path extra field" "unicode" 'cat generated.zip/unicode/*'
+
 cd ..
 echo "Killing ziprofs"
 fusermount -u "$REPODIR/test/mnt"
 kill $PID
+rm -rf "$GENDIR" "$REPODIR/test/data/generated.zip"
 
 echo "$PASSEDTESTS/$TOTALTESTS tests passed."
 if [[ "$PASTELOG" == "-log" ]]; then
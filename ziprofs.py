@@ -8,13 +8,18 @@ from os.path import realpath
 import argparse
 import ctypes
 import errno
+import itertools
 import logging
 import os
 import time
 import zipfile
 import stat
-from threading import RLock
-from typing import Optional, Dict
+import struct
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock, RLock
+from typing import Optional, Dict, List, Tuple, Union
 
 try:
     from fuse import FUSE, FuseOSError, Operations, LoggingMixIn, S_IFDIR, fuse_operations
@@ -24,95 +29,524 @@ except ImportError:
     from fusepy import FUSE, FuseOSError, Operations, LoggingMixIn, S_IFDIR, fuse_operations
     import fusepy
 
-from collections import OrderedDict
+from lru import LRU
 
 
 @lru_cache(maxsize=2048)
-def is_zipfile(path, mtime):
-    # mtime just to miss cache on changed files
+def is_zipfile(path, mtime_ns, size):
+    # mtime and size just to miss cache on changed or replaced files
     return zipfile.is_zipfile(path)
 
 
+@lru_cache(maxsize=4096)
+def zip_mtime(date_time) -> Optional[float]:
+    # zip entries store local time, archives tend to share few distinct stamps
+    try:
+        return time.mktime(date_time + (0, 0, -1))
+    except (OverflowError, ValueError):
+        return None
+
+
+def dir_entry(entry: os.DirEntry, st_dev: int, root_dev: int):
+    # pass file type known from readdir along so that kernel reports d_type and
+    # listing tools don't need to stat every entry just to find out its type
+    name = entry.name
+    if name[-4:] == '.zip':
+        # could be shown as a directory, leave it to getattr
+        return name
+    if entry.is_symlink():
+        mode = stat.S_IFLNK
+    elif entry.is_dir(follow_symlinks=False):
+        mode = S_IFDIR
+    elif entry.is_file(follow_symlinks=False):
+        mode = stat.S_IFREG
+    else:
+        return name
+    return name, {'st_mode': mode, 'st_ino': file_ino(st_dev, entry.inode(), root_dev)}, 0
+
+
+def file_ino(st_dev: int, st_ino: int, root_dev: int) -> int:
+    # inodes of root device are kept, ones of other filesystems mounted under
+    # root get their device folded in so that the two can't clash
+    if st_dev == root_dev:
+        return st_ino
+    return hash((st_dev, st_ino)) & 0xFFFFFFFFFFFFFFFF
+
+
+# getattr is the hottest op, a literal display is about twice as fast as a
+# getattr() per key and beats dict(zip(keys, attrgetter(*keys)(st))) as well
+def stat_dict(st: os.stat_result) -> dict:
+    return {
+        'st_atime': st.st_atime, 'st_ctime': st.st_ctime, 'st_gid': st.st_gid,
+        'st_ino': st.st_ino, 'st_mode': st.st_mode, 'st_mtime': st.st_mtime,
+        'st_nlink': st.st_nlink, 'st_size': st.st_size, 'st_uid': st.st_uid,
+    }
+
+
+def statvfs_dict(stv: os.statvfs_result) -> dict:
+    return {
+        'f_bavail': stv.f_bavail, 'f_bfree': stv.f_bfree, 'f_blocks': stv.f_blocks,
+        'f_bsize': stv.f_bsize, 'f_favail': stv.f_favail, 'f_ffree': stv.f_ffree,
+        'f_files': stv.f_files, 'f_flag': stv.f_flag, 'f_frsize': stv.f_frsize,
+        'f_namemax': stv.f_namemax,
+    }
+
+
 class ZipFile(zipfile.ZipFile):
+    # entry inodes are archive identity in upper half plus entry number
+    INO_SHIFT = 32
+    INO_MASK = 0xFFFFFFFF
+    _serials = itertools.count()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.__lock = RLock()
+        # tells apart instances of the same path, archive may have been replaced
+        self.serial = next(self._serials)
+        # directory -> readdir result, built on first listing
+        self._listings: Dict[str, tuple] = {}
+        self._data_offsets: Dict[str, int] = {}
+        # subpath -> (archive ctime, getattr result)
+        self._attr_cache: Dict[str, Tuple[float, dict]] = {}
+        # every cached archive gets stat'ed right away, no point in deferring
+        self._build_index()
+
+    def is_stored(self, info: zipfile.ZipInfo) -> bool:
+        # uncompressed and unencrypted, data can be read from archive as is
+        return info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1
+
+    def prefetch(self, info: zipfile.ZipInfo, size: int):
+        # start reading entry data in background, only a hint
+        # zero length would mean up to the end of archive
+        if hasattr(os, 'posix_fadvise') and info.compress_size:
+            os.posix_fadvise(
+                self.fp.fileno(), self.data_offset(info), min(info.compress_size, size),
+                os.POSIX_FADV_WILLNEED)
+
+    def data_offset(self, info: zipfile.ZipInfo) -> int:
+        offset = self._data_offsets.get(info.filename)
+        if offset is None:
+            # local header extra field may differ from the central directory one
+            header = os.pread(self.fp.fileno(), zipfile.sizeFileHeader, info.header_offset)
+            if len(header) != zipfile.sizeFileHeader:
+                raise zipfile.BadZipFile("Truncated file header")
+            header = struct.unpack(zipfile.structFileHeader, header)
+            if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+                raise zipfile.BadZipFile("Bad magic number for file header")
+            offset = (info.header_offset + zipfile.sizeFileHeader
+                      + header[zipfile._FH_FILENAME_LENGTH]
+                      + header[zipfile._FH_EXTRA_FIELD_LENGTH])
+            self._data_offsets[info.filename] = offset
+        return offset
+
+    def entry_info(self, subpath: str) -> Optional[zipfile.ZipInfo]:
+        index = self._index.get(subpath)
+        if index is None or self._records[index] < 0:
+            return None
+        return self.filelist[self._records[index]]
+
+    def _build_index(self):
+        # Runs over every entry of the archive, kept free of per iteration
+        # attribute lookups and throwaway allocations. Entries are numbered,
+        # per entry fields live in flat arrays instead of an object each.
+        # subpath -> entry number, which is also its inode number less one
+        index: Dict[str, int] = {}
+        # entry number -> position in filelist, -1 for directories that have
+        # no entry of their own
+        records = array('q')
+        # entry number -> 1 for directories
+        dirs = bytearray()
+        # directory -> child names, a path is numbered and so added to its
+        # parent only once, lists hold them in a fraction of a set's memory
+        dir_children: Dict[str, List[str]] = {'': []}
+        get_children = dir_children.get
+        # names are taken from ZipInfo to match getinfo(), stdlib may replace
+        # the one in central directory with its unicode path extra field
+        for record, info in enumerate(self.filelist):
+            name = info.filename
+            is_dir = name[-1:] == '/'
+            if is_dir:
+                name = name.rstrip('/')
+                if not name:
+                    continue
+                if name not in dir_children:
+                    dir_children[name] = []
+            number = index.get(name)
+            if number is not None:
+                # files win over directories, otherwise last record wins like
+                # in stdlib NameToInfo
+                if not is_dir or dirs[number]:
+                    records[number] = record
+                    dirs[number] = is_dir
+                continue
+            index[name] = len(records)
+            records.append(record)
+            dirs.append(is_dir)
+            # register name with its parent and all missing ancestors
+            while True:
+                parent, _, child = name.rpartition('/')
+                children = get_children(parent)
+                if children is None:
+                    children = dir_children[parent] = []
+                children.append(child)
+                if not parent or parent in index:
+                    break
+                index[parent] = len(records)
+                records.append(-1)
+                dirs.append(True)
+                name = parent
+        self._index = index
+        self._records = records
+        self._dirs = dirs
+        self._dir_children = dir_children
+
+    def is_file(self, subpath: str) -> bool:
+        index = self._index.get(subpath)
+        return index is not None and not self._dirs[index]
+
+    def ino(self, subpath: str, archive_st: os.stat_result) -> int:
+        # whole archive device and inode folded into upper half, truncating would
+        # collide on 64 bit inode numbers (xfs inode64, nfs, overlayfs xino).
+        # Only 32 bits of hash are kept, two archives can still share a key.
+        archive_key = hash((archive_st.st_dev, archive_st.st_ino)) & self.INO_MASK
+        return (archive_key << self.INO_SHIFT) | ((self._index[subpath] + 1) & self.INO_MASK)
+
+    def readdir(self, subpath: str, archive_st: os.stat_result) -> tuple:
+        # entries can't change for this instance, so neither can the listing
+        listing = self._listings.get(subpath)
+        if listing is None:
+            children = self._dir_children.get(subpath)
+            if children is None:
+                return ('.', '..')
+            prefix = subpath + '/' if subpath else ''
+            items = ['.', '..']
+            for name in sorted(children):
+                name_path = prefix + name
+                mode = stat.S_IFREG if self.is_file(name_path) else S_IFDIR
+                items.append(
+                    (name, {'st_mode': mode, 'st_ino': self.ino(name_path, archive_st)}, 0))
+            listing = self._listings[subpath] = tuple(items)
+        return listing
+
+
+class DecompPageCache(object):
+    """Decompressed pages of compressed zip entries, shared by all handles."""
+    PAGE_SIZE = 1 << 16
+    MAX_BYTES = 64 << 20
 
-    def lock(self):
-        return self.__lock
+    def __init__(self):
+        self.pages = LRU(self.MAX_BYTES // self.PAGE_SIZE)
+
+    def resize(self, max_bytes: int):
+        self.MAX_BYTES = max_bytes
+        if self.enabled():
+            self.pages.set_size(max_bytes // self.PAGE_SIZE)
+        else:
+            self.pages.clear()
+
+    def enabled(self) -> bool:
+        return self.MAX_BYTES >= self.PAGE_SIZE
+
+    def get(self, key) -> Optional[bytes]:
+        return self.pages.get(key)
+
+    def put(self, key, data: bytes):
+        self.pages[key] = data
+
+
+class FileReader(object):
+    """Reads file outside of archives, lock free."""
+
+    def __init__(self, fd: int):
+        self.fd = fd
+
+    def read(self, size: int, offset: int) -> bytes:
+        return os.pread(self.fd, size, offset)
+
+    def close(self):
+        return os.close(self.fd)
+
+
+class StoredEntryReader(object):
+    """Reads uncompressed zip entry straight from the archive, lock free."""
+
+    def __init__(self, fd: int, data_offset: int, size: int):
+        self.fd = fd
+        self.data_offset = data_offset
+        self.size = size
+
+    def read(self, size: int, offset: int) -> bytes:
+        size = min(size, self.size - offset)
+        if size <= 0:
+            return b''
+        return os.pread(self.fd, size, self.data_offset + offset)
+
+    def close(self):
+        return os.close(self.fd)
+
+
+class InlineEntryReader(object):
+    """Serves small zip entry decompressed as a whole on open, lock free."""
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def read(self, size: int, offset: int) -> bytes:
+        return self.data[offset:offset + size]
+
+    def close(self):
+        self.data = b''
+
+
+class ZipEntryReader(object):
+    """Reads compressed zip entry keeping a window of recently decompressed data.
+
+    Going back in a compressed stream means decompressing it again from the
+    start, kernel readahead often steps back a little which is served from
+    the window instead.
+    """
+    WINDOW_SIZE = 1 << 20
+
+    def __init__(self, f: zipfile.ZipExtFile, cache: DecompPageCache, cache_key: tuple):
+        self.f = f
+        self.cache = cache
+        # identifies the entry in cache, page number is appended to it
+        self.cache_key = cache_key
+        # data right before self.pos
+        self.window = bytearray()
+        self.pos = 0
+        # ZipExtFile positions the shared archive file itself, only its own
+        # decompression state needs guarding against concurrent reads
+        self.lock = RLock()
+        self._inflight: Dict[Tuple[int, int], Future] = {}
+
+    def _read(self, size: int) -> bytes:
+        data = self.f.read(size)
+        self.pos += len(data)
+        self.window += data
+        if len(self.window) > 2 * self.WINDOW_SIZE:
+            # trim rarely, keeps appends amortized
+            del self.window[:-self.WINDOW_SIZE]
+        return data
+
+    def _read_at(self, size: int, offset: int) -> bytes:
+        if offset == self.pos:
+            return self._read(size)
+        window_start = self.pos - len(self.window)
+        if window_start <= offset < self.pos:
+            start = offset - window_start
+            data = bytes(self.window[start:start + size])
+            if len(data) < size:
+                data += self._read(size - len(data))
+            return data
+        if not self.f.seekable():
+            raise FuseOSError(errno.EBADF)
+        self.f.seek(offset)
+        self.pos = self.f.tell()
+        self.window = bytearray()
+        return self._read(size)
+
+    def _read_pages(self, size: int, offset: int) -> bytes:
+        page_size = self.cache.PAGE_SIZE
+        first = offset // page_size
+        pages = []
+        for page in range(first, (offset + size - 1) // page_size + 1):
+            key = self.cache_key + (page,)
+            data = self.cache.get(key)
+            if data is None:
+                data = self._read_at(page_size, page * page_size)
+                if not data:
+                    break
+                self.cache.put(key, data)
+            pages.append(data)
+            if len(data) < page_size:
+                # end of entry
+                break
+        start = offset - first * page_size
+        return b''.join(pages)[start:start + size]
+
+    def read(self, size: int, offset: int) -> bytes:
+        # identical requests issued concurrently wait for the first one
+        key = (offset, size)
+        future = Future()
+        pending = self._inflight.setdefault(key, future)
+        if pending is not future:
+            return pending.result()
+        try:
+            with self.lock:
+                if self.cache.enabled():
+                    data = self._read_pages(size, offset)
+                else:
+                    data = self._read_at(size, offset)
+            future.set_result(data)
+            return data
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self._inflight[key]
+
+    def close(self):
+        with self.lock:
+            return self.f.close()
 
 
 class CachedZipFactory(object):
     MAX_CACHE_SIZE = 1000
-    cache = OrderedDict()
     log = logging.getLogger('ziprofs.cache')
 
     def __init__(self):
         self.__lock = RLock()
+        # CLOCK ring, path -> [(mtime_ns, size), zf, referenced], oldest first. Hits only
+        # set the referenced bit so they never reorder the ring.
+        self.cache: Dict[str, list] = OrderedDict()
+        # path -> [lock, number of threads using it]
+        self._openers: Dict[str, list] = {}
+
+    def _evict(self, size: int):
+        # caller holds self.__lock, referenced entries get a second chance
+        while len(self.cache) > size:
+            path, entry = self.cache.popitem(last=False)
+            if entry[2]:
+                entry[2] = False
+                self.cache[path] = entry
+            else:
+                self.log.debug('Popping cache entry: %s', path)
+                entry[1].close()
 
-    def _add(self, path: str):
-        if path in self.cache:
-            return
-        while len(self.cache) >= self.MAX_CACHE_SIZE:
-            oldpath, val = self.cache.popitem(last=False)
-            self.log.debug('Popping cache entry: %s', oldpath)
-            val[1].close()
-        mtime = os.lstat(path).st_mtime
-        self.log.debug("Caching path (%s:%s)", path, mtime)
-        self.cache[path] = (mtime, ZipFile(path))
-
-    def get(self, path: str) -> ZipFile:
+    def resize(self, size: int):
         with self.__lock:
-            if path in self.cache:
-                self.cache.move_to_end(path)
-                mtime = os.lstat(path).st_mtime
-                if mtime > self.cache[path][0]:
-                    val = self.cache.pop(path)
-                    val[1].close()
-                    self._add(path)
-            else:
-                self._add(path)
-            return self.cache[path][1]
+            self.MAX_CACHE_SIZE = size
+            self._evict(size)
+
+    def _fresh(self, path: str, stamp: Tuple[int, int]) -> Optional[ZipFile]:
+        # any change counts, a replacing archive may well have an older mtime
+        entry = self.cache.get(path)
+        if entry and stamp == entry[0]:
+            entry[2] = True
+            return entry[1]
+        return None
+
+    def get(self, path: str, st: os.stat_result) -> ZipFile:
+        # st comes from the caller's stat cache, so hits make no syscall,
+        # take no lock and don't touch the ring
+        stamp = (st.st_mtime_ns, st.st_size)
+        zf = self._fresh(path, stamp)
+        if zf is not None:
+            return zf
+        # only threads opening the same archive wait for each other, parsing
+        # central directory of a big archive takes a while
+        with self.__lock:
+            opener = self._openers.get(path)
+            if opener is None:
+                opener = self._openers[path] = [Lock(), 0]
+            opener[1] += 1
+        try:
+            with opener[0]:
+                zf = self._fresh(path, stamp)
+                if zf is not None:
+                    return zf
+                self.log.debug("Caching path (%s:%s)", path, stamp)
+                zf = ZipFile(path)
+                with self.__lock:
+                    old = self.cache.pop(path, None)
+                    self._evict(self.MAX_CACHE_SIZE - 1)
+                    self.cache[path] = [stamp, zf, False]
+                if old:
+                    old[1].close()
+                return zf
+        finally:
+            with self.__lock:
+                opener[1] -= 1
+                if not opener[1]:
+                    del self._openers[path]
 
 
 class ZipROFS(Operations):
+    # how much of an entry the kernel is asked to read ahead of time on open
+    PREFETCH_SIZE = 1 << 20
+    # at most this many archives of a listing get checked in background
+    PREFETCH_ZIPS = 256
     zip_factory = CachedZipFactory()
+    content_cache = DecompPageCache()
 
-    def __init__(self, root, zip_check):
+    def __init__(self, root, zip_check, stat_ttl=1.0, inline_size=256 << 10):
         self.root = realpath(root)
+        self.root_dev = os.stat(self.root).st_dev
         self.zip_check = zip_check
-        # odd file handles are files inside zip, even fhs are system-wide files
-        self._zip_file_fh: Dict[int, zipfile.ZipExtFile] = {}
-        self._zip_zfile_fh: Dict[int, ZipFile] = {}
-        self._fh_locks: Dict[int, RLock] = {}
-        self._lock = RLock()
+        self.stat_ttl = stat_ttl
+        # compressed entries up to this size are decompressed whole on open
+        self.inline_size = inline_size
+        # path -> (expiry, stat), stat is None for paths that are not zip files
+        self._zip_path_cache = LRU(4096)
+        # path -> (expiry, zip path, stat), resolved get_zip_path results
+        self._resolve_cache = LRU(4096)
+        # path -> (expiry, getattr result)
+        self._getattr_cache = LRU(4096)
+        # path -> (dev, ino, mtime_ns, size) of the file or archive at last open
+        self._open_versions = LRU(4096)
+        # every open file, in archive or not, is a reader keyed by its handle
+        self._readers: Dict[int, Union[
+            FileReader, StoredEntryReader, InlineEntryReader, ZipEntryReader]] = {}
+        # next() on count is atomic, handles are allocated without a lock
+        self._fh_counter = itertools.count(5)   # avoid confusion with stdin/err/out
+        # stats and checks archives of a listing before getattr asks for them
+        self._prefetch = ThreadPoolExecutor(max_workers=2)
 
     def __call__(self, op, path, *args):
-        return super().__call__(op, self.root + path, *args)
-
-    def _get_free_zip_fh(self):
-        i = 5   # avoid confusion with stdin/err/out
-        while i in self._zip_file_fh:
-            i += 2
-        return i
-
-    def get_zip_path(self, path: str) -> Optional[str]:
-        parts = []
-        head, tail = os.path.split(path)
-        while tail:
-            parts.append(tail)
-            head, tail = os.path.split(head)
-        parts.reverse()
-        cur_path = '/'
-        for part in parts:
-            cur_path = os.path.join(cur_path, part)
-            if part[-4:] == '.zip' and (
-                    not self.zip_check or is_zipfile(cur_path, os.lstat(cur_path).st_mtime)):
-                return cur_path
-        return None
+        # entry point of every kernel request, look the handler up only once
+        try:
+            handler = getattr(self, op)
+        except AttributeError:
+            raise FuseOSError(errno.EFAULT)
+        return handler(self.root + path, *args)
+
+    def _zip_stat(self, path: str) -> Tuple[float, Optional[os.stat_result]]:
+        now = time.monotonic()
+        entry = self._zip_path_cache.get(path)
+        if entry and entry[0] > now:
+            return entry
+        st = os.lstat(path)
+        if self.zip_check and not is_zipfile(path, st.st_mtime_ns, st.st_size):
+            st = None
+        entry = self._zip_path_cache[path] = (now + self.stat_ttl, st)
+        return entry
+
+    def _prefetch_zip_stats(self, paths: List[str]):
+        for path in paths:
+            try:
+                self._zip_stat(path)
+            except OSError:
+                pass
+
+    def get_zip_path(self, path: str) -> Tuple[Optional[str], Optional[os.stat_result]]:
+        """Returns path of the zip file containing path and its lstat result."""
+        if '.zip' not in path:
+            return None, None
+        entry = self._resolve_cache.get(path)
+        if entry and entry[0] > time.monotonic():
+            return entry[1], entry[2]
+        # scan for components ending in .zip, slicing prefixes from path itself,
+        # result is valid as long as all stats it was based on
+        expiry = float('inf')
+        zip_path, st = None, None
+        end = 0
+        while True:
+            end = path.find('.zip', end)
+            if end < 0:
+                break
+            end += 4
+            if end == len(path) or path[end] == '/':
+                cur_path = path[:end]
+                cur_expiry, cur_st = self._zip_stat(cur_path)
+                expiry = min(expiry, cur_expiry)
+                if cur_st is not None:
+                    zip_path, st = cur_path, cur_st
+                    break
+        self._resolve_cache[path] = (expiry, zip_path, st)
+        return zip_path, st
 
     def access(self, path, mode):
-        if self.get_zip_path(path):
+        if self.get_zip_path(path)[0]:
             if mode & os.W_OK:
                 raise FuseOSError(errno.EROFS)
         else:
@@ -120,117 +554,109 @@ class ZipROFS(Operations):
                 raise FuseOSError(errno.EACCES)
 
     def getattr(self, path, fh=None):
-        zip_path = self.get_zip_path(path)
-        st = os.lstat(zip_path) if zip_path else os.lstat(path)
-        result = {key: getattr(st, key) for key in (
-            'st_atime', 'st_ctime', 'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'
-        )}
+        now = time.monotonic()
+        entry = self._getattr_cache.get(path)
+        if entry and entry[0] > now:
+            return entry[1]
+        result = self._getattr(path)
+        self._getattr_cache[path] = (now + self.stat_ttl, result)
+        return result
+
+    def _getattr(self, path):
+        zip_path, st = self.get_zip_path(path)
+        if not zip_path:
+            st = os.lstat(path)
+        elif zip_path != path:
+            zf = self.zip_factory.get(zip_path, st)
+            subpath = path[len(zip_path) + 1:]
+            # entries can't change for a cached zf, ctime catches archive chmod/chown
+            cached = zf._attr_cache.get(subpath)
+            if cached and cached[0] == st.st_ctime:
+                return cached[1]
+        result = stat_dict(st)
+        result['st_ino'] = file_ino(st.st_dev, st.st_ino, self.root_dev)
         if zip_path == path:
             result['st_mode'] = S_IFDIR | (result['st_mode'] & 0o555)
         elif zip_path:
-            zf = self.zip_factory.get(zip_path)
-            subpath = path[len(zip_path) + 1:]
-            info = None
-            try:
-                info = zf.getinfo(subpath)
+            # index lookups only, no scan of the entry list for any path
+            info = zf.entry_info(subpath)
+            if info is not None and not info.is_dir():
                 result['st_size'] = info.file_size
                 result['st_mode'] = stat.S_IFREG | 0o555
-            except KeyError:
-                # check if it is a valid subdirectory
-                try:
-                    info = zf.getinfo(subpath + '/')
-                except KeyError:
-                    pass
-                found = False
-                if not info:
-                    infolist = zf.infolist()
-                    for f in infolist:
-                        if f.filename.find(subpath + '/') == 0:
-                            found = True
-                            break
-                if found or info:
-                    result['st_mode'] = S_IFDIR | 0o555
-                else:
-                    raise FuseOSError(errno.ENOENT)
+            elif subpath in zf._dir_children:
+                result['st_mode'] = S_IFDIR | 0o555
+            else:
+                raise FuseOSError(errno.ENOENT)
+            result['st_ino'] = zf.ino(subpath, st)
             if info:
-                # update mtime
-                try:
-                    mtime = time.mktime(info.date_time + (0, 0, -1))
+                mtime = zip_mtime(info.date_time)
+                if mtime is not None:
                     result['st_mtime'] = mtime
-                except Exception:
-                    pass
+            zf._attr_cache[subpath] = (st.st_ctime, result)
         return result
 
-    def open(self, path, flags):
-        zip_path = self.get_zip_path(path)
+    def open(self, path, fi):
+        # mounted with raw_fi, fi is the kernel's fuse_file_info
+        zip_path, st = self.get_zip_path(path)
         if zip_path:
-            with self._lock:
-                fh = self._get_free_zip_fh()
-                zf = self.zip_factory.get(zip_path)
-                self._zip_zfile_fh[fh] = zf
-                self._zip_file_fh[fh] = zf.open(path[len(zip_path) + 1:])
-                return fh
-        else:
-            fh = os.open(path, flags) << 1
-            self._fh_locks[fh] = RLock()
-            return fh
-
-    def read(self, path, size, offset, fh):
-        if fh in self._zip_file_fh:
-            # should be here (file is first opened, then read)
-            f = self._zip_file_fh[fh]
-            with self._zip_zfile_fh[fh].lock():
-                if not f.seekable():
-                    raise FuseOSError(errno.EBADF)
-
-                f.seek(offset)
-                return f.read(size)
+            zf = self.zip_factory.get(zip_path, st)
+            subpath = path[len(zip_path) + 1:]
+            info = zf.getinfo(subpath)
+            zf.prefetch(info, self.PREFETCH_SIZE)
+            if zf.is_stored(info):
+                reader = StoredEntryReader(
+                    os.dup(zf.fp.fileno()), zf.data_offset(info), info.file_size)
+            elif info.file_size <= self.inline_size:
+                # likely read whole right after open anyway
+                reader = InlineEntryReader(zf.read(info))
+            else:
+                reader = ZipEntryReader(
+                    zf.open(info), self.content_cache, (zf.serial, subpath))
         else:
-            with self._fh_locks[fh]:
-                os.lseek(fh >> 1, offset, 0)
-                return os.read(fh >> 1, size)
+            # flags may truncate the file
+            self._getattr_cache.pop(path, None)
+            reader = FileReader(os.open(path, fi.flags))
+            st = os.fstat(reader.fd)
+        # Pages kernel cached on an earlier open stay valid until the file, or
+        # the archive holding it, changes. Entry's own mtime and size can't tell,
+        # archives may be rebuilt with pinned timestamps.
+        version = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+        fi.keep_cache = int(self._open_versions.get(path) == version)
+        self._open_versions[path] = version
+        fi.fh = next(self._fh_counter)
+        self._readers[fi.fh] = reader
+        return 0
+
+    def read(self, path, size, offset, fi):
+        return self._readers[fi.fh].read(size, offset)
 
     def readdir(self, path, fh):
-        zip_path = self.get_zip_path(path)
+        zip_path, st = self.get_zip_path(path)
         if not zip_path:
-            return ['.', '..'] + os.listdir(path)
+            items = ['.', '..']
+            zips = []
+            # entries share device of the directory, mount points aside
+            st_dev = os.stat(path).st_dev
+            with os.scandir(path) as it:
+                for entry in it:
+                    items.append(dir_entry(entry, st_dev, self.root_dev))
+                    if entry.name[-4:] == '.zip':
+                        zips.append(entry.path)
+            if zips:
+                self._prefetch.submit(self._prefetch_zip_stats, zips[:self.PREFETCH_ZIPS])
+            return items
         subpath = path[len(zip_path) + 1:]
-        zf = self.zip_factory.get(zip_path)
-        infolist = zf.infolist()
-
-        result = ['.', '..']
-        subdirs = set()
-        for info in infolist:
-            if info.filename.find(subpath) == 0 and info.filename > subpath:
-                suffix = info.filename[len(subpath) + 1 if subpath else 0:]
-                if not suffix:
-                    continue
-                if '/' not in suffix:
-                    result.append(suffix)
-                else:
-                    subdirs.add(suffix[:suffix.find('/')])
-        result.extend(subdirs)
-        return result
+        zf = self.zip_factory.get(zip_path, st)
+        return zf.readdir(subpath, st)
 
-    def release(self, path, fh):
-        if fh in self._zip_file_fh:
-            with self._lock:
-                f = self._zip_file_fh[fh]
-                with self._zip_zfile_fh[fh].lock():
-                    del self._zip_file_fh[fh]
-                    del self._zip_zfile_fh[fh]
-                    return f.close()
-        else:
-            with self._fh_locks[fh]:
-                del self._fh_locks[fh]
-                return os.close(fh >> 1)
+    def release(self, path, fi):
+        reader = self._readers.pop(fi.fh)
+        if isinstance(reader, FileReader):
+            self._getattr_cache.pop(path, None)
+        return reader.close()
 
     def statfs(self, path):
-        stv = os.statvfs(path)
-        return dict((key, getattr(stv, key)) for key in (
-            'f_bavail', 'f_bfree', 'f_blocks', 'f_bsize', 'f_favail',
-            'f_ffree', 'f_files', 'f_flag', 'f_frsize', 'f_namemax'
-        ))
+        return statvfs_dict(os.statvfs(path))
 
 
 class ZipROFSDebug(LoggingMixIn, ZipROFS):
@@ -247,28 +673,33 @@ class fuse_conn_info(ctypes.Structure):
         ('max_readahead', ctypes.c_uint),
         ('capable', ctypes.c_uint),
         ('want', ctypes.c_uint),
-        ('reserved', ctypes.c_uint, 25)]
+        ('max_background', ctypes.c_uint),
+        ('congestion_threshold', ctypes.c_uint),
+        ('reserved', ctypes.c_uint * 23)]
+
+
+# fusepy declares init callback argument as a void pointer, redeclare it once
+# as fuse_conn_info so ZipROFuse.init can tune the connection
+fusepy.fuse_operations = type('fuse_operations', (ctypes.Structure,), {'_fields_': [
+    ('init', ctypes.CFUNCTYPE(ctypes.c_voidp, ctypes.POINTER(fuse_conn_info)))
+    if field[0] == 'init' else field
+    for field in fuse_operations._fields_
+]})
 
 
 class ZipROFuse(FUSE):
+    MAX_READAHEAD = 1 << 20
+    MAX_BACKGROUND = 32
+
     def __init__(self, operations, mountpoint, **kwargs):
         self.support_async = kwargs.get('support_async', False)
         del kwargs['support_async']
-        if not self.support_async:
-            # monkeypatch fuse_operations
-            ops = fuse_operations._fields_
-            for i in range(len(ops)):
-                if ops[i][0] == 'init':
-                    ops[i] = (
-                        'init',
-                        ctypes.CFUNCTYPE(
-                            ctypes.c_voidp, ctypes.POINTER(fuse_conn_info))
-                    )
-                fusepy.fuse_operations = type(
-                    'fuse_operations', (ctypes.Structure,), {'_fields_': ops})
         super().__init__(operations, mountpoint, **kwargs)
 
     def init(self, conn):
+        # allow kernel to read ahead in large chunks, fewer zip seeks and lock rounds
+        conn[0].max_readahead = self.MAX_READAHEAD
+        conn[0].max_background = self.MAX_BACKGROUND
         if not self.support_async:
             conn[0].async_read = 0
             conn[0].want = conn.contents.want & ~1
@@ -298,7 +729,8 @@ if __name__ == '__main__':
     parser.add_argument(
         '-o', metavar='options', dest='opts',
         help="comma separated list of options: foreground, debug, allowother, "
-        "nozipcheck, async, cachesize=N",
+        "nozipcheck, async, cachesize=N, contentcache=N, statttl=N, inlinesize=N, "
+        "entry_timeout=N, attr_timeout=N, negative_timeout=N",
         type=parse_mount_opts, default={})
     arg = parser.parse_args()
 
@@ -306,22 +738,45 @@ if __name__ == '__main__':
         cache_size = int(arg.opts['cachesize'])
         if cache_size < 1:
             raise ValueError("Bad cache size")
-        CachedZipFactory.MAX_CACHE_SIZE = cache_size
+        ZipROFS.zip_factory.resize(cache_size)
+
+    if 'contentcache' in arg.opts:
+        content_cache_size = int(arg.opts['contentcache'])
+        if content_cache_size < 0:
+            raise ValueError("Bad content cache size")
+        ZipROFS.content_cache.resize(content_cache_size << 20)
 
     logging.basicConfig(
         level=logging.DEBUG if 'debug' in arg.opts else logging.INFO)
 
     zip_check = 'nozipcheck' not in arg.opts
+    stat_ttl = float(arg.opts.get('statttl', 1.0))
+    if stat_ttl < 0:
+        raise ValueError("Bad stat ttl")
+
+    inline_size = int(arg.opts.get('inlinesize', 256))
+    if inline_size < 0:
+        raise ValueError("Bad inline size")
 
     if 'debug' in arg.opts:
-        fs = ZipROFSDebug(arg.root, zip_check)
+        fs = ZipROFSDebug(arg.root, zip_check, stat_ttl, inline_size << 10)
     else:
-        fs = ZipROFS(arg.root, zip_check)
+        fs = ZipROFS(arg.root, zip_check, stat_ttl, inline_size << 10)
+
+    # mount is read only, let kernel cache lookups and attributes
+    timeouts = {
+        name: float(arg.opts.get(name, default)) for name, default in (
+            ('entry_timeout', 60), ('attr_timeout', 60), ('negative_timeout', 10))
+    }
 
     fuse = ZipROFuse(
         fs,
         arg.mountpoint,
         foreground=('foreground' in arg.opts),
         allow_other=('allowother' in arg.opts),
-        support_async=('async' in arg.opts)
+        support_async=('async' in arg.opts),
+        max_read=ZipROFuse.MAX_READAHEAD,
+        raw_fi=True,
+        use_ino=True,
+        **timeouts
     )